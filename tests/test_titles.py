@@ -10,143 +10,280 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import bisect
+from concurrent import futures
+import functools
 import glob
+import itertools
 import os
+import pickle
 import re
 
 import docutils.core
-import six
+from docutils import nodes
 import testtools
 
 
-OPTIONAL_SECTIONS = ("Upper level additional section",)
-OPTIONAL_SUBSECTIONS = ("Some additional section",)
-OPTIONAL_SUBSUBSECTIONS = ("Parameters", "Some additional section",)
-OPTIONAL_FIELDS = ("Conventions",)
+OPTIONAL_SECTIONS = frozenset(("Upper level additional section",))
+OPTIONAL_SUBSECTIONS = frozenset(("Some additional section",))
+OPTIONAL_SUBSUBSECTIONS = frozenset(("Parameters", "Some additional section",))
+OPTIONAL_FIELDS = frozenset(("Conventions",))
 
+TEMPLATES_CACHE = os.path.join(".cache", "test_titles_templates.pkl")
+# Bump whenever _get_titles or _get_docinfo change what they return, so
+# cached templates computed by older code are not reused.
+_CACHE_VERSION = 1
 
-class TestTitles(testtools.TestCase):
-    def _get_title(self, section_tree, depth=1):
+# NOTE: only section titles and docinfo are looked at, so do not report
+# parser warnings and skip raw content. File insertion and the doctitle
+# transform stay enabled: plans include sections from other files and the
+# templates rely on the plan title being promoted to the document title.
+_DOCUTILS_SETTINGS = {
+    "report_level": 5,
+    "raw_enabled": False,
+}
+
+_NON_WS_LINE = re.compile(r"\s*\S+$")
+# Lines of 80 or more characters are matched with an empty lookahead, so
+# the scan still finds trailing whitespace at the end of those lines.
+_LINE_PROBLEMS = re.compile(r"(?P<long>^(?=.{80}))|(?P<trailing>[^\S\n]+$)",
+                            re.MULTILINE)
+
+_Docinfo = nodes.docinfo
+_FieldList = nodes.field_list
+_Section = nodes.section
+_Title = nodes.title
+_Topic = nodes.topic
+
+
+def _get_titles(test_plan):
+    # NOTE: walk the doctree with an explicit stack instead of recursion.
+    # Only three levels of sections are reported, so deeper sections are
+    # never visited.
+    titles = {}
+    stack = [(node, 1, None) for node in reversed(test_plan)
+             if type(node) is _Section]
+    while stack:
+        node, depth, parent = stack.pop()
         section = {
             "subtitles": [],
         }
-        for node in section_tree:
-            if node.tagname == "title":
-                section["name"] = node.rawsource
-            elif node.tagname == "section":
-                subsection = self._get_title(node, depth+1)
-                if depth < 2:
-                    if subsection["subtitles"]:
-                        section["subtitles"].append(subsection)
-                    else:
-                        section["subtitles"].append(subsection["name"])
-                elif depth == 2:
-                    section["subtitles"].append(subsection["name"])
-        return section
-
-    def _get_titles(self, test_plan):
-        titles = {}
-        for node in test_plan:
-            if node.tagname == "section":
-                section = self._get_title(node)
-                titles[section["name"]] = section["subtitles"]
-        return titles
-
-    @staticmethod
-    def _get_docinfo(test_plan):
-        fields = []
-        for node in test_plan:
-            if node.tagname == "field_list":
-                for field in node:
-                    for f_opt in field:
-                        if f_opt.tagname == "field_name":
-                            fields.append(f_opt.rawsource)
-
-            if node.tagname == "docinfo":
-                for info in node:
-                    fields.append(info.tagname)
-
-            if node.tagname == "topic":
-                fields.append("abstract")
-
-        return fields
-
-    def _check_fields(self, tmpl, test_plan):
-        tmpl_fields = self._get_docinfo(tmpl)
-        test_plan_fields = self._get_docinfo(test_plan)
-
-        missing_fields = [f for f in tmpl_fields
-                          if f not in test_plan_fields and
-                          f not in OPTIONAL_FIELDS]
-
-        if len(missing_fields) > 0:
-            self.fail("While checking '%s':\n  %s"
-                      % (test_plan[0].rawsource,
-                         "Missing fields: %s" % missing_fields))
-
-    def _check_titles(self, filename, expect, actual):
-        missing_sections = [x for x in expect.keys() if (
-            x not in actual.keys()) and (x not in OPTIONAL_SECTIONS)]
-
-        msgs = []
-        if len(missing_sections) > 0:
-            msgs.append("Missing sections: %s" % missing_sections)
-
-        for section in expect.keys():
-            missing_subsections = [x for x in expect[section]
-                                   if x not in actual.get(section, {}) and
-                                   (x not in OPTIONAL_SUBSECTIONS)]
-            extra_subsections = [x for x in actual.get(section, {})
-                                 if x not in expect[section]]
-
-            for ex_s in extra_subsections:
-                s_name = (ex_s if isinstance(ex_s, six.string_types)
-                          else ex_s["name"])
-                if s_name.startswith("Test Case"):
-                    new_missing_subsections = []
-                    for m_s in missing_subsections:
-                        m_s_name = (m_s if isinstance(m_s, six.string_types)
-                                    else m_s["name"])
-                        if not m_s_name.startswith("Test Case"):
-                            new_missing_subsections.append(m_s)
-                    missing_subsections = new_missing_subsections
-                    break
-
-            if len(missing_subsections) > 0:
-                msgs.append("Section '%s' is missing subsections: %s"
-                            % (section, missing_subsections))
-
-            for subsection in expect[section]:
-                if type(subsection) is dict:
-                    missing_subsubsections = []
-                    actual_section = actual.get(section, {})
-                    matching_actual_subsections = [
-                        s for s in actual_section
-                        if type(s) is dict and (
-                            s["name"] == subsection["name"] or
-                            (s["name"].startswith("Test Case") and
-                             subsection["name"].startswith("Test Case")))
-                        ]
-                    for actual_subsection in matching_actual_subsections:
-                        for x in subsection["subtitles"]:
-                            if (x not in actual_subsection["subtitles"] and
-                                    x not in OPTIONAL_SUBSUBSECTIONS):
-                                missing_subsubsections.append(x)
-                        if len(missing_subsubsections) > 0:
-                            msgs.append("Subsection '%s' is missing "
-                                        "subsubsections: %s"
-                                        % (actual_subsection,
-                                           missing_subsubsections))
-
-        if len(msgs) > 0:
-            self.fail("While checking '%s':\n  %s"
-                      % (filename, "\n  ".join(msgs)))
-
-    def _check_lines_wrapping(self, tpl, raw):
+        children = []
+        for child in node:
+            if type(child) is _Title:
+                section["name"] = child.rawsource
+            elif type(child) is _Section and depth < 3:
+                children.append(child)
+
+        if depth == 1:
+            titles[section["name"]] = section["subtitles"]
+        elif depth == 2 and children:
+            parent.append(section)
+        else:
+            parent.append(section["name"])
+
+        stack.extend((child, depth + 1, section["subtitles"])
+                     for child in reversed(children))
+    return titles
+
+
+def _get_docinfo(test_plan):
+    fields = []
+    for node in test_plan:
+        node_type = type(node)
+        if node_type is _FieldList:
+            # NOTE: a field always starts with its field_name node
+            fields.extend(field[0].rawsource for field in node)
+        elif node_type is _Docinfo:
+            fields.extend(info.tagname for info in node)
+        elif node_type is _Topic:
+            fields.append("abstract")
+
+    return fields
+
+
+@functools.lru_cache(maxsize=None)
+def _parsed_template(path, text):
+    # NOTE: the same template is shared by most of the test plans, so
+    # parse every unique template only once. The path is passed on to
+    # resolve include directives relative to the template directory.
+    return docutils.core.publish_doctree(
+        text, source_path=path, settings_overrides=_DOCUTILS_SETTINGS)
+
+
+@functools.lru_cache(maxsize=None)
+def _template_titles(path, text):
+    return _get_titles(_parsed_template(path, text))
+
+
+@functools.lru_cache(maxsize=None)
+def _template_docinfo_fields(path, text):
+    return tuple(_get_docinfo(_parsed_template(path, text)))
+
+
+def _template_meta(path, text):
+    return (_template_titles(path, text),
+            _template_docinfo_fields(path, text))
+
+
+def _read_template_meta(path):
+    # NOTE: set TEST_TITLES_CACHE=1 to keep parsed templates on disk
+    # between test runs.
+    if os.environ.get("TEST_TITLES_CACHE") == "1":
+        stat = os.stat(path)
+        return _cached_template_meta(os.path.abspath(path),
+                                     stat.st_mtime, stat.st_size)
+
+    with open(path) as f:
+        return _template_meta(path, f.read())
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_template_meta(path, mtime, size):
+    key = (_CACHE_VERSION, tuple(sorted(_DOCUTILS_SETTINGS.items())),
+           path, mtime, size)
+    try:
+        with open(TEMPLATES_CACHE, "rb") as f:
+            cache = pickle.load(f)
+    except Exception:
+        # a missing, corrupt or foreign cache file is just a cache miss
+        cache = {}
+    if not isinstance(cache, dict):
+        cache = {}
+
+    if key not in cache:
+        with open(path) as f:
+            meta = _template_meta(path, f.read())
+        # drop entries left over from older versions of the template or
+        # of this module
+        cache = dict((k, v) for k, v in cache.items()
+                     if isinstance(k, tuple) and k[2:3] != (path,))
+        cache[key] = meta
+
+        # several test workers may update the cache at once, so write a
+        # private copy and atomically move it into place
+        os.makedirs(os.path.dirname(TEMPLATES_CACHE), exist_ok=True)
+        tmp_path = "%s.%d" % (TEMPLATES_CACHE, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache, f)
+        os.replace(tmp_path, TEMPLATES_CACHE)
+
+    return cache[key]
+
+
+def _check_fields(tmpl_fields, test_plan):
+    test_plan_fields = _get_docinfo(test_plan)
+
+    missing_fields = [f for f in tmpl_fields
+                      if f not in test_plan_fields and
+                      f not in OPTIONAL_FIELDS]
+
+    if len(missing_fields) > 0:
+        return ["While checking '%s':\n  %s"
+                % (test_plan[0].rawsource,
+                   "Missing fields: %s" % missing_fields)]
+    return []
+
+
+def _as_hashable(subsection):
+    if isinstance(subsection, str):
+        return subsection
+    return subsection["name"], tuple(subsection["subtitles"])
+
+
+def _check_titles(filename, expect, actual):
+    missing_sections = [x for x in expect.keys() if (
+        x not in actual.keys()) and (x not in OPTIONAL_SECTIONS)]
+
+    msgs = []
+    if len(missing_sections) > 0:
+        msgs.append("Missing sections: %s" % missing_sections)
+
+    for section, expected_subsections in expect.items():
+        if not expected_subsections:
+            continue
+
+        actual_subsections = actual.get(section, [])
+        expected_keys = [_as_hashable(x) for x in expected_subsections]
+        actual_keys = set(_as_hashable(x) for x in actual_subsections)
+        missing_subsections = [
+            x for x, key in zip(expected_subsections, expected_keys)
+            if key not in actual_keys and key not in OPTIONAL_SUBSECTIONS]
+        expected_keys = set(expected_keys)
+        extra_subsections = [x for x in actual_subsections
+                             if _as_hashable(x) not in expected_keys]
+
+        for ex_s in extra_subsections:
+            s_name = ex_s if isinstance(ex_s, str) else ex_s["name"]
+            if s_name.startswith("Test Case"):
+                new_missing_subsections = []
+                for m_s in missing_subsections:
+                    m_s_name = m_s if isinstance(m_s, str) else m_s["name"]
+                    if not m_s_name.startswith("Test Case"):
+                        new_missing_subsections.append(m_s)
+                missing_subsections = new_missing_subsections
+                break
+
+        if len(missing_subsections) > 0:
+            msgs.append("Section '%s' is missing subsections: %s"
+                        % (section, missing_subsections))
+
+        for subsection in expected_subsections:
+            if type(subsection) is dict:
+                missing_subsubsections = []
+                matching_actual_subsections = [
+                    s for s in actual_subsections
+                    if type(s) is dict and (
+                        s["name"] == subsection["name"] or
+                        (s["name"].startswith("Test Case") and
+                         subsection["name"].startswith("Test Case")))
+                    ]
+                for actual_subsection in matching_actual_subsections:
+                    actual_subtitles = set(actual_subsection["subtitles"])
+                    for x in subsection["subtitles"]:
+                        if (x not in actual_subtitles and
+                                x not in OPTIONAL_SUBSUBSECTIONS):
+                            missing_subsubsections.append(x)
+                    if len(missing_subsubsections) > 0:
+                        msgs.append("Subsection '%s' is missing "
+                                    "subsubsections: %s"
+                                    % (actual_subsection,
+                                       missing_subsubsections))
+
+    if len(msgs) > 0:
+        return ["While checking '%s':\n  %s"
+                % (filename, "\n  ".join(msgs))]
+    return []
+
+
+def _check_file_lines(tpl, raw):
+    msgs = []
+    # NOTE: most of the plans are clean, so find every long line and every
+    # line with trailing whitespace in a single regex scan of the file and
+    # only look at single lines when it finds something.
+    trailing_spaces = []
+    long_lines = []
+    problems = list(_LINE_PROBLEMS.finditer(raw))
+    if problems:
+        lines = raw.split("\n")
+        line_ends = list(itertools.accumulate(len(line) + 1
+                                              for line in lines))
+        for match in problems:
+            i = bisect.bisect_right(line_ends, match.start())
+            if match.lastgroup == "trailing":
+                trailing_spaces.append(i)
+            else:
+                long_lines.append(i)
+
+    for i in trailing_spaces:
+        msgs.append("Found trailing spaces on line %s of %s" % (i + 1, tpl))
+
+    if long_lines:
+        # The code block and table state only depends on the lines above,
+        # so there is no need to look past the last long line.
         code_block = False
         text_inside_simple_tables = False
-        lines = raw.split("\n")
-        for i, line in enumerate(lines):
+        for i, line in enumerate(itertools.islice(lines, long_lines[-1] + 1)):
             # NOTE(ndipanov): Allow code block lines to be longer than 79 ch
             if code_block:
                 if not line or line.startswith(" "):
@@ -162,60 +299,226 @@ class TestTitles(testtools.TestCase):
             if "http://" in line or "https://" in line:
                 continue
             # Allow lines which do not contain any whitespace
-            if re.match("\s*[^\s]+$", line):
+            if _NON_WS_LINE.match(line):
                 continue
-            if not text_inside_simple_tables:
-                self.assertTrue(
-                    len(line) < 80,
-                    msg="%s:%d: Line limited to a maximum of 79 characters." %
-                    (tpl, i + 1))
+            if not text_inside_simple_tables and len(line) >= 80:
+                msgs.append("%s:%d: Line limited to a maximum of 79 "
+                            "characters." % (tpl, i + 1))
             # close simple style table
-            if "===" in line and not lines[i + 1]:
+            if ("===" in line and i + 1 < len(lines) and
+                    not lines[i + 1]):
                 text_inside_simple_tables = False
 
-    def _check_no_cr(self, tpl, raw):
-        matches = re.findall("\r", raw)
-        self.assertEqual(
-            len(matches), 0,
-            "Found %s literal carriage returns in file %s" %
-            (len(matches), tpl))
+    cr_count = raw.count("\r")
+    if cr_count > 0:
+        msgs.append("Found %s literal carriage returns in file %s"
+                    % (cr_count, tpl))
+
+    return msgs
+
+
+def _check_one(filename, global_template_path):
+    with open(filename) as f:
+        data = f.read()
+
+    template_path = os.path.join(os.path.dirname(filename), "template.rst")
+    #  Try to use template in directory where plan.rst is located
+    if not os.path.isfile(template_path):
+        # use global template
+        template_path = global_template_path
+
+    template_titles, tmpl_fields = _read_template_meta(template_path)
+    # include directives are resolved relative to the plan directory
+    test_plan = docutils.core.publish_doctree(
+        data, source_path=filename, settings_overrides=_DOCUTILS_SETTINGS)
+    errors = []
+    errors.extend(_check_titles(filename,
+                                template_titles,
+                                _get_titles(test_plan)))
+    errors.extend(_check_fields(tmpl_fields, test_plan))
+    errors.extend(_check_file_lines(filename, data))
+    return errors
 
-    def _check_trailing_spaces(self, tpl, raw):
-        for i, line in enumerate(raw.split("\n")):
-            trailing_spaces = re.findall("\s+$", line)
-            self.assertEqual(
-                len(trailing_spaces), 0,
-                "Found trailing spaces on line %s of %s" % (i + 1, tpl))
 
+class TestTitles(testtools.TestCase):
     def test_template(self):
         # Global repository template
-        with open("doc/source/test_plans/template.rst") as f:
-            global_template = f.read()
-
-        files = glob.glob("doc/source/test_plans/*/plan.rst")
-        files = [os.path.abspath(filename) for filename in files]
-
-        for filename in files:
-            with open(filename) as f:
-                data = f.read()
-
-            os.chdir(os.path.dirname(filename))
-            #  Try to use template in directory where plan.rst is located
-            try:
-                with open("template.rst") as f:
-                    # use local template
-                    template = f.read()
-            except Exception:
-                # use global template
-                template = global_template
-                pass
-            test_plan_tmpl = docutils.core.publish_doctree(template)
-            template_titles = self._get_titles(test_plan_tmpl)
-            test_plan = docutils.core.publish_doctree(data)
-            self._check_titles(filename,
-                               template_titles,
-                               self._get_titles(test_plan))
-            self._check_fields(test_plan_tmpl, test_plan)
-            self._check_lines_wrapping(filename, data)
-            self._check_no_cr(filename, data)
-            self._check_trailing_spaces(filename, data)
+        global_template_path = os.path.abspath(
+            "doc/source/test_plans/template.rst")
+
+        files = (os.path.abspath(filename) for filename
+                 in glob.iglob("doc/source/test_plans/*/plan.rst"))
+
+        # NOTE: every plan is checked independently and docutils parsing
+        # is CPU bound, so spread the plans across worker processes.
+        templates = itertools.repeat(global_template_path)
+        errors = []
+        with futures.ProcessPoolExecutor() as executor:
+            for file_errors in executor.map(_check_one, files, templates,
+                                            chunksize=8):
+                errors.extend(file_errors)
+
+        if len(errors) > 0:
+            self.fail("\n".join(errors))
+
+
+class TestGetTitles(testtools.TestCase):
+    def test_titles(self):
+        test_plan = docutils.core.publish_doctree("""
+==========
+Plan title
+==========
+
+Intro
+=====
+
+Test Plan
+=========
+
+Environment
+-----------
+
+Test Case 1
+-----------
+
+Description
+^^^^^^^^^^^
+
+Details
+~~~~~~~
+
+Deep
+++++
+
+Metrics
+^^^^^^^
+""", settings_overrides=_DOCUTILS_SETTINGS)
+        self.assertEqual(
+            {"Intro": [],
+             "Test Plan": [
+                 "Environment",
+                 {"name": "Test Case 1",
+                  "subtitles": ["Description", "Metrics"]}]},
+            _get_titles(test_plan))
+
+
+class TestCheckFileLines(testtools.TestCase):
+    LONG = "word " * 16 + "word"
+
+    def _long_msg(self, line):
+        return ("plan.rst:%d: Line limited to a maximum of 79 characters."
+                % line)
+
+    def _trailing_msg(self, line):
+        return "Found trailing spaces on line %d of plan.rst" % line
+
+    def test_clean(self):
+        self.assertEqual([], _check_file_lines("plan.rst", "a b\n\nc d\n"))
+
+    def test_long_line_with_trailing_spaces(self):
+        raw = "intro\n" + self.LONG + "  \nend\n"
+        self.assertEqual([self._trailing_msg(2), self._long_msg(2)],
+                         _check_file_lines("plan.rst", raw))
+
+    def test_long_whitespace_only_line(self):
+        raw = "intro\n" + " " * 85 + "\nend\n"
+        self.assertEqual([self._trailing_msg(2), self._long_msg(2)],
+                         _check_file_lines("plan.rst", raw))
+
+    def test_crlf(self):
+        raw = "first line\r\nsecond line\r\n"
+        self.assertEqual(
+            [self._trailing_msg(1), self._trailing_msg(2),
+             "Found 2 literal carriage returns in file plan.rst"],
+            _check_file_lines("plan.rst", raw))
+
+    def test_last_line_without_newline(self):
+        self.assertEqual([self._long_msg(2)],
+                         _check_file_lines("plan.rst", "a\n" + self.LONG))
+        self.assertEqual([self._trailing_msg(2)],
+                         _check_file_lines("plan.rst", "a\nb "))
+
+    def test_long_table_border_as_last_line(self):
+        raw = "a\n" + self.LONG + " ==="
+        self.assertEqual([self._long_msg(2)],
+                         _check_file_lines("plan.rst", raw))
+
+    def test_long_line_in_code_block(self):
+        raw = ("Example::\n"
+               "\n"
+               "    " + self.LONG + "\n"
+               "\n" +
+               self.LONG + "\n")
+        self.assertEqual([self._long_msg(5)],
+                         _check_file_lines("plan.rst", raw))
+
+    def test_long_line_in_simple_table(self):
+        raw = ("text\n"
+               "\n"
+               "=====  =====\n" +
+               self.LONG + "\n"
+               "=====  =====\n"
+               "\n" +
+               self.LONG + "\n")
+        self.assertEqual([self._long_msg(7)],
+                         _check_file_lines("plan.rst", raw))
+
+
+class TestCheckTitles(testtools.TestCase):
+    def _msg(self, *msgs):
+        return ["While checking 'plan.rst':\n  %s" % "\n  ".join(msgs)]
+
+    def test_matching(self):
+        titles = {"Intro": [], "Test Plan": ["Environment"]}
+        self.assertEqual([], _check_titles("plan.rst", titles, titles))
+
+    def test_missing_sections(self):
+        expect = {"Intro": [], "Upper level additional section": [],
+                  "Test Plan": ["Environment", "Some additional section"]}
+        actual = {"Test Plan": ["Other"]}
+        self.assertEqual(
+            self._msg("Missing sections: ['Intro']",
+                      "Section 'Test Plan' is missing subsections: "
+                      "['Environment']"),
+            _check_titles("plan.rst", expect, actual))
+
+    def test_section_without_expected_subsections(self):
+        self.assertEqual([], _check_titles("plan.rst", {"Intro": []},
+                                           {"Intro": ["Anything"]}))
+
+    def test_renamed_test_case(self):
+        expect = {"Test Plan": ["Environment", "Test Case 1: Name"]}
+        actual = {"Test Plan": ["Environment", "Test Case 1: Boot VMs"]}
+        self.assertEqual([], _check_titles("plan.rst", expect, actual))
+
+    def test_missing_test_case(self):
+        expect = {"Test Plan": ["Environment", "Test Case 1: Name"]}
+        actual = {"Test Plan": ["Environment"]}
+        self.assertEqual(
+            self._msg("Section 'Test Plan' is missing subsections: "
+                      "['Test Case 1: Name']"),
+            _check_titles("plan.rst", expect, actual))
+
+    def test_missing_subsubsections(self):
+        expect = {"Test Plan": [
+            {"name": "Test Case 1: Name",
+             "subtitles": ["Description", "Parameters", "Metrics"]}]}
+        actual = {"Test Plan": [
+            {"name": "Test Case 1: Boot VMs",
+             "subtitles": ["Description"]}]}
+        self.assertEqual(
+            self._msg("Subsection '{'name': 'Test Case 1: Boot VMs', "
+                      "'subtitles': ['Description']}' is missing "
+                      "subsubsections: ['Metrics']"),
+            _check_titles("plan.rst", expect, actual))
+
+    def test_reordered_subsubsections(self):
+        expect = {"Test Plan": [{"name": "Environment",
+                                 "subtitles": ["Hardware", "Software"]}]}
+        actual = {"Test Plan": [{"name": "Environment",
+                                 "subtitles": ["Software", "Hardware"]}]}
+        self.assertEqual(
+            self._msg("Section 'Test Plan' is missing subsections: "
+                      "[{'name': 'Environment', "
+                      "'subtitles': ['Hardware', 'Software']}]"),
+            _check_titles("plan.rst", expect, actual))